@@ -10,11 +10,63 @@
 # Security, Inc. MD5 Message-Digest Algorithm. Self-contained single-file
 # implementation; with macros replaced with functions.
 
+import sys
+import time
+
 
 def main() -> None:
     assert "b10a8db164e0754105b7a99be72e3fe5" == md5hash(b"Hello World")
     assert "b223cca8b360eae4e49568512e2de29f" == md5hash(b"1" * 10000)
 
+    messages = [b"", b"Hello World", b"a" * 55, bytes(range(17))]
+    assert [md5hash(m) for m in messages] == md5hash_bitsliced(messages)
+    assert [md5hash(m) for m in messages] == md5hash_swar(messages)
+
+    prefix, nfree = b"Hello World", 2
+    mask, value = 0xF << 124, 0
+    start, count = 0x1200, 256
+    found = search_bitsliced(prefix, nfree, mask, value, start, count)
+    candidates = [
+        prefix + i.to_bytes(nfree, "big") for i in range(start, start + count)
+    ]
+    assert found == [m for m in candidates if int(md5hash(m), 16) & mask == value]
+
+
+def bench() -> None:
+    # Brute-force search for two-byte suffixes of a fixed prefix whose digest
+    # starts with a null byte.
+    prefix, nfree = b"Hello World", 2
+    mask, value = 0xFF << 120, 0
+    lanes = 4096
+    count = 1 << (8 * nfree)
+
+    print("[+] Benchmarking candidate evaluation")
+    print(f"    {'engine':>12} {'candidates':>10} {'matches':>8} {'cand/s':>10}")
+
+    candidates = [prefix + i.to_bytes(nfree, "big") for i in range(count)]
+
+    t = time.perf_counter()
+    n = 4096
+    found = [m for m in candidates[:n] if int(md5hash(m), 16) & mask == value]
+    t = time.perf_counter() - t
+    print(f"    {'scalar':>12} {n:>10} {len(found):>8} {n / t:>10.0f}")
+
+    t = time.perf_counter()
+    found = []
+    for i in range(0, count, lanes):
+        batch = candidates[i : i + lanes]
+        digests = md5hash_swar(batch)
+        found += [m for m, h in zip(batch, digests) if int(h, 16) & mask == value]
+    t = time.perf_counter() - t
+    print(f"    {'swar':>12} {count:>10} {len(found):>8} {count / t:>10.0f}")
+
+    t = time.perf_counter()
+    found = []
+    for start in range(0, count, lanes):
+        found += search_bitsliced(prefix, nfree, mask, value, start, lanes)
+    t = time.perf_counter() - t
+    print(f"    {'bitsliced':>12} {count:>10} {len(found):>8} {count / t:>10.0f}")
+
 
 class U32:
     def __init__(self, val: int):
@@ -319,5 +371,312 @@ def transform(state: list[U32], block: list[U8]) -> list[U32]:
     return [state[0] + a, state[1] + b, state[2] + c, state[3] + d]
 
 
+# Steps of transform as (round function, message word, shift, constant).
+STEPS = [
+    # Round 1
+    (F, 0, 7, 0xD76AA478),
+    (F, 1, 12, 0xE8C7B756),
+    (F, 2, 17, 0x242070DB),
+    (F, 3, 22, 0xC1BDCEEE),
+    (F, 4, 7, 0xF57C0FAF),
+    (F, 5, 12, 0x4787C62A),
+    (F, 6, 17, 0xA8304613),
+    (F, 7, 22, 0xFD469501),
+    (F, 8, 7, 0x698098D8),
+    (F, 9, 12, 0x8B44F7AF),
+    (F, 10, 17, 0xFFFF5BB1),
+    (F, 11, 22, 0x895CD7BE),
+    (F, 12, 7, 0x6B901122),
+    (F, 13, 12, 0xFD987193),
+    (F, 14, 17, 0xA679438E),
+    (F, 15, 22, 0x49B40821),
+    # Round 2
+    (G, 1, 5, 0xF61E2562),
+    (G, 6, 9, 0xC040B340),
+    (G, 11, 14, 0x265E5A51),
+    (G, 0, 20, 0xE9B6C7AA),
+    (G, 5, 5, 0xD62F105D),
+    (G, 10, 9, 0x2441453),
+    (G, 15, 14, 0xD8A1E681),
+    (G, 4, 20, 0xE7D3FBC8),
+    (G, 9, 5, 0x21E1CDE6),
+    (G, 14, 9, 0xC33707D6),
+    (G, 3, 14, 0xF4D50D87),
+    (G, 8, 20, 0x455A14ED),
+    (G, 13, 5, 0xA9E3E905),
+    (G, 2, 9, 0xFCEFA3F8),
+    (G, 7, 14, 0x676F02D9),
+    (G, 12, 20, 0x8D2A4C8A),
+    # Round 3
+    (H, 5, 4, 0xFFFA3942),
+    (H, 8, 11, 0x8771F681),
+    (H, 11, 16, 0x6D9D6122),
+    (H, 14, 23, 0xFDE5380C),
+    (H, 1, 4, 0xA4BEEA44),
+    (H, 4, 11, 0x4BDECFA9),
+    (H, 7, 16, 0xF6BB4B60),
+    (H, 10, 23, 0xBEBFBC70),
+    (H, 13, 4, 0x289B7EC6),
+    (H, 0, 11, 0xEAA127FA),
+    (H, 3, 16, 0xD4EF3085),
+    (H, 6, 23, 0x4881D05),
+    (H, 9, 4, 0xD9D4D039),
+    (H, 12, 11, 0xE6DB99E5),
+    (H, 15, 16, 0x1FA27CF8),
+    (H, 2, 23, 0xC4AC5665),
+    # Round 4
+    (I, 0, 6, 0xF4292244),
+    (I, 7, 10, 0x432AFF97),
+    (I, 14, 15, 0xAB9423A7),
+    (I, 5, 21, 0xFC93A039),
+    (I, 12, 6, 0x655B59C3),
+    (I, 3, 10, 0x8F0CCC92),
+    (I, 10, 15, 0xFFEFF47D),
+    (I, 1, 21, 0x85845DD1),
+    (I, 8, 6, 0x6FA87E4F),
+    (I, 15, 10, 0xFE2CE6E0),
+    (I, 6, 15, 0xA3014314),
+    (I, 13, 21, 0x4E0811A1),
+    (I, 4, 6, 0xF7537E82),
+    (I, 11, 10, 0xBD3AF235),
+    (I, 2, 15, 0x2AD7D2BB),
+    (I, 9, 21, 0xEB86D391),
+]
+
+IV = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476]
+
+
+# Single padded block of a message of at most 55 bytes.
+def pad_block(val: bytes) -> bytes:
+    assert len(val) < 56, f"Message has length {len(val)}"
+    bits = (len(val) * 8).to_bytes(8, "little")
+    return val + b"\x80" + b"\x00" * (55 - len(val)) + bits
+
+
+# Lane-vectorized (SWAR) variant: each 32-bit word of the computation is one
+# large integer holding the corresponding word of many messages, one per
+# 64-bit lane. The upper half of each lane absorbs the carries of additions,
+# which are cleared after every step.
+
+
+def md5hash_swar(vals: list[bytes]) -> list[str]:
+    n = len(vals)
+    lanemask = int.from_bytes(b"\xff\xff\xff\xff\x00\x00\x00\x00" * n, "little")
+
+    blocks = [pad_block(v) for v in vals]
+    x = [
+        int.from_bytes(
+            b"".join(b[4 * k : 4 * k + 4] + b"\x00" * 4 for b in blocks), "little"
+        )
+        for k in range(16)
+    ]
+
+    def const(val: int) -> int:
+        return lanemask // 0xFFFFFFFF * val
+
+    state = [const(v) for v in IV]
+    reg = list(state)
+
+    for i, (f, k, s, ac) in enumerate(STEPS):
+        # Registers in rotated order starting with the updated one.
+        r = -i % 4
+        a, b, c, d = reg[r], reg[(r + 1) % 4], reg[(r + 2) % 4], reg[(r + 3) % 4]
+        if f is F:
+            fv = (b & c) | ((b ^ lanemask) & d)
+        elif f is G:
+            fv = (b & d) | (c & (d ^ lanemask))
+        elif f is H:
+            fv = b ^ c ^ d
+        else:
+            fv = c ^ (b | (d ^ lanemask))
+        t = (a + fv + x[k] + const(ac)) & lanemask
+        t = ((t << s) | (t >> (32 - s))) & lanemask
+        reg[r] = (b + t) & lanemask
+
+    words = [
+        ((state[j] + reg[j]) & lanemask).to_bytes(8 * n, "little") for j in range(4)
+    ]
+    return [bytes.hex(b"".join(w[8 * i : 8 * i + 4] for w in words)) for i in range(n)]
+
+
+# Bit-sliced variant: each 32-bit word of the computation is a list of 32
+# integers, where bit i of the word of message k is bit k of the i-th integer.
+# The round functions become plain bitwise operations over all lanes at once
+# and additions become ripple-carry adders.
+
+
+def bs_const(val: int, lanes: int) -> list[int]:
+    return [lanes if (val >> i) & 1 else 0 for i in range(32)]
+
+
+# Ripple-carry addition of the lowest `nbits` bits.
+def bs_add(x: list[int], y: list[int], nbits: int = 32) -> list[int]:
+    res = [0] * nbits
+    carry = 0
+    for i in range(nbits):
+        t = x[i] ^ y[i]
+        res[i] = t ^ carry
+        carry = (x[i] & y[i]) | (carry & t)
+    return res
+
+
+def bs_rotate_left(x: list[int], n: int) -> list[int]:
+    return x[32 - n :] + x[: 32 - n]
+
+
+def bs_F(x: list[int], y: list[int], z: list[int], lanes: int) -> list[int]:
+    return [(xi & yi) | ((xi ^ lanes) & zi) for xi, yi, zi in zip(x, y, z)]
+
+
+def bs_G(x: list[int], y: list[int], z: list[int], lanes: int) -> list[int]:
+    return [(xi & zi) | (yi & (zi ^ lanes)) for xi, yi, zi in zip(x, y, z)]
+
+
+def bs_H(x: list[int], y: list[int], z: list[int], lanes: int) -> list[int]:
+    return [xi ^ yi ^ zi for xi, yi, zi in zip(x, y, z)]
+
+
+def bs_I(x: list[int], y: list[int], z: list[int], lanes: int) -> list[int]:
+    return [yi ^ (xi | (zi ^ lanes)) for xi, yi, zi in zip(x, y, z)]
+
+
+# Bit-sliced counterparts of the round functions in STEPS.
+BS_FUNCS = {F: bs_F, G: bs_G, H: bs_H, I: bs_I}
+
+
+# Message words of the given single blocks in bit-sliced form.
+def bitslice_blocks(blocks: list[bytes]) -> list[list[int]]:
+    x = []
+    for k in range(16):
+        words = [int.from_bytes(b[4 * k : 4 * k + 4], "little") for b in blocks]
+        x.append(
+            [
+                sum(((w >> i) & 1) << lane for lane, w in enumerate(words))
+                for i in range(32)
+            ]
+        )
+    return x
+
+
+# Apply step `i` of transform to the bit-sliced registers `reg` in place.
+# Returns the index of the updated register.
+def bs_step(reg: list[list[int]], x: list[list[int]], lanes: int, i: int) -> int:
+    f, k, s, ac = STEPS[i]
+    r = -i % 4
+    a, b, c, d = reg[r], reg[(r + 1) % 4], reg[(r + 2) % 4], reg[(r + 3) % 4]
+    t = bs_add(a, BS_FUNCS[f](b, c, d, lanes))
+    t = bs_add(t, x[k])
+    t = bs_add(t, bs_const(ac, lanes))
+    reg[r] = bs_add(b, bs_rotate_left(t, s))
+    return r
+
+
+# Run transform on a single block from the initial state for all lanes set in
+# `lanes` and return the output words.
+def bs_transform(x: list[list[int]], lanes: int) -> list[list[int]]:
+    state = [bs_const(v, lanes) for v in IV]
+    reg = list(state)
+    for i in range(len(STEPS)):
+        bs_step(reg, x, lanes, i)
+    return [bs_add(s, r) for s, r in zip(state, reg)]
+
+
+# Like bs_transform, but only return the lanes whose output words (as state
+# words) match the (mask, value) pairs in `want`. The last four steps each
+# produce one final register, so lanes which fail are dropped as soon as the
+# corresponding output word is known, i.e. after step 61 for the first word.
+# The computation stops once no lane is left or after the last constrained
+# word.
+def bs_match(x: list[list[int]], lanes: int, want: list[tuple[int, int]]) -> int:
+    last = [i for i in range(len(STEPS) - 4, len(STEPS)) if want[-i % 4][0]]
+    if not last:
+        return lanes
+
+    state = [bs_const(v, lanes) for v in IV]
+    reg = list(state)
+    for i in range(last[-1] + 1):
+        r = bs_step(reg, x, lanes, i)
+        if i < len(STEPS) - 4 or want[r][0] == 0:
+            continue
+
+        mask, value = want[r]
+        # Lower output bits only depend on lower input bits.
+        out = bs_add(state[r], reg[r], mask.bit_length())
+        for j in range(mask.bit_length()):
+            if (mask >> j) & 1:
+                lanes &= ~(out[j] ^ (lanes if (value >> j) & 1 else 0))
+        if lanes == 0:
+            break
+
+    return lanes
+
+
+def bs_unslice(word: list[int], lane: int) -> int:
+    return sum(((bit >> lane) & 1) << i for i, bit in enumerate(word))
+
+
+def md5hash_bitsliced(vals: list[bytes]) -> list[str]:
+    lanes = (1 << len(vals)) - 1
+    out = bs_transform(bitslice_blocks([pad_block(v) for v in vals]), lanes)
+    return [
+        bytes.hex(b"".join(bs_unslice(w, lane).to_bytes(4, "little") for w in out))
+        for lane in range(len(vals))
+    ]
+
+
+# Brute-force search over messages `prefix + i.to_bytes(nfree, "big")` for i in
+# range(start, start + count), returning those whose digest (as big-endian
+# integer) matches `value` on the bits set in `mask`. The candidates are
+# generated directly in bit-sliced form. `count` must be a power of two and
+# `start` a multiple of it.
+def search_bitsliced(
+    prefix: bytes, nfree: int, mask: int, value: int, start: int, count: int
+) -> list[bytes]:
+    assert count & (count - 1) == 0 and start % count == 0
+    lanes = (1 << count) - 1
+    e = count.bit_length() - 1
+
+    # Bit t of the counter over all lanes: periodic for the lower e bits,
+    # constant for the rest.
+    def counter_bit(t: int) -> int:
+        if t >= e:
+            return lanes if (start >> t) & 1 else 0
+        # 2^t zeros followed by 2^t ones, repeated over all lanes.
+        w = 1 << (t + 1)
+        unit = ((1 << (w // 2)) - 1) << (w // 2)
+        return lanes // ((1 << w) - 1) * unit
+
+    block = pad_block(prefix + bytes(nfree))
+    x = []
+    for k in range(16):
+        word = []
+        for i in range(32):
+            p = 4 * k + i // 8
+            if len(prefix) <= p < len(prefix) + nfree:
+                q = len(prefix) + nfree - 1 - p
+                word.append(counter_bit(8 * q + i % 8))
+            else:
+                word.append(lanes if (block[p] >> (i % 8)) & 1 else 0)
+        x.append(word)
+
+    # The digest consists of the state words in little-endian byte order.
+    maskbytes, valuebytes = mask.to_bytes(16, "big"), value.to_bytes(16, "big")
+    want = [
+        (
+            int.from_bytes(maskbytes[4 * j : 4 * j + 4], "little"),
+            int.from_bytes(valuebytes[4 * j : 4 * j + 4], "little"),
+        )
+        for j in range(4)
+    ]
+    lanes = bs_match(x, lanes, want)
+
+    return [
+        prefix + (start + lane).to_bytes(nfree, "big")
+        for lane in range(count)
+        if (lanes >> lane) & 1
+    ]
+
+
 if __name__ == "__main__":
-    main()
+    modes = {"check": main, "bench": bench}
+    modes[sys.argv[1] if len(sys.argv) > 1 else "check"]()
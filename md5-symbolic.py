@@ -10,8 +10,15 @@
 
 
 import z3
-from typing import Callable
+from typing import Callable, Iterable, Iterator
+import itertools
+import multiprocessing
+import os
+import queue
+import random
+import resource
 import sys
+import time
 
 MD5_HASH_BITLEN = 128
 
@@ -27,6 +34,55 @@ def main() -> None:
     # assert "b223cca8b360eae4e49568512e2de29f" == md5hash_(b"1" * 10000)
     # => that works
 
+    # Multi-block input with non-uniform data, which also checks the order in
+    # which blocks are taken from the input.
+    assert "7acedd1a84a4cfcb6e7a16003242945e" == md5hash_(bytes(range(100)))
+
+    # The same message constructed block by block, with the chaining values
+    # given by the returned constraints.
+    msg = bytes(range(100))
+    hash, constraints = md5hash_blocks(
+        [bv_from_bytes(msg[i : i + 64]) for i in range(0, len(msg), 64)], "cv"
+    )
+    s = z3.Solver()
+    s.add(constraints)
+    assert s.check() == z3.sat
+    assert "7acedd1a84a4cfcb6e7a16003242945e" == hex_from_bv(s.model().evaluate(hash))
+
+    # The solution set of the GF(2) solver used for sampling agrees with brute
+    # force on small random systems.
+    rng = random.Random(0)
+    for _ in range(100):
+        rows = [rng.getrandbits(6) for _ in range(rng.randrange(8))]
+        rhs = [rng.getrandbits(1) for _ in rows]
+        brute = {
+            v
+            for v in range(1 << 6)
+            if all(bin(r & v).count("1") % 2 == b for r, b in zip(rows, rhs))
+        }
+        cell = gf2_solve(rows, rhs, 6)
+        solved = set()
+        if cell is not None:
+            x0, basis = cell
+            for y in range(1 << len(basis)):
+                v = x0
+                for j, w in enumerate(basis):
+                    if (y >> j) & 1:
+                        v ^= w
+                solved.add(v)
+        assert brute == solved
+
+    # A query fixing the whole digest, which runs the last steps backwards, is
+    # satisfied by a known preimage and not by a changed message.
+    query_data = z3.BitVec("query_data", 16)
+    query_hash = z3.BitVec("query_hash", MD5_HASH_BITLEN)
+    digest = bv_from_bytes(bytes.fromhex(md5hash_(b"hi")))
+    query = md5_query(query_data, query_hash, [query_hash == digest], backward=True)
+    for msg, expected in [(b"hi", True), (b"ho", False)]:
+        sub = [(query_data, bv_from_bytes(msg)), (query_hash, digest)]
+        res = [z3.simplify(z3.substitute(e, *sub)) for e in query]
+        assert expected == all(z3.is_true(e) for e in res)
+
     data = z3.BitVec("data", MD5_HASH_BITLEN + 8)
     print(
         f"[+] Constructing bitvector of {data.size()} bits "
@@ -55,6 +111,14 @@ def main() -> None:
     # Find message whose checksum ends with two null bytes.
     # s.add(z3.Extract(2 * 8 - 1, 0, hash) == z3.BitVecVal(0, 2 * 8))
 
+    # Find message with a given checksum. Passing the constraints on a plain
+    # hash variable to md5_query with `backward=True` runs the last steps
+    # backwards when they fix the whole digest (see the `backward` mode for
+    # whether that pays off).
+    # hash = z3.BitVec("hash", MD5_HASH_BITLEN)
+    # digest = z3.BitVecVal(0xB10A8DB164E0754105B7A99BE72E3FE5, MD5_HASH_BITLEN)
+    # s.add(md5_query(data, hash, [hash == digest], backward=True))
+
     for i in range(4):
         s = z3.Solver()
 
@@ -93,6 +157,183 @@ def main() -> None:
             print(f"    MD5 hash: {hex_from_bv(m.evaluate(hash))}")
 
 
+def main_pair() -> None:
+    sys.set_int_max_str_digits(0)
+
+    # Both messages share everything but their last five bytes.
+    nbytes = (MD5_HASH_BITLEN + 8) // 8
+    differing = list(range(nbytes - 5, nbytes))
+
+    data1 = z3.BitVec("data1", nbytes * 8)
+    data2 = pair_data(data1, differing)
+    print(
+        "[+] Constructing paired symbolic hash computation for two messages of "
+        + f"{data1.size()} bits differing in bytes {differing}"
+    )
+    t = time.perf_counter()
+    hash1, hash2 = md5hash(data1), md5hash(data2)
+    t_shared = time.perf_counter() - t
+
+    # For comparison: two fully independent circuits over separate variables,
+    # with the shared parts tied together by constraints instead.
+    t = time.perf_counter()
+    naive2 = z3.BitVec("naive2", data1.size())
+    naive_hash1 = md5hash(data1)
+    naive_hash2 = md5hash(naive2)
+    naive_tie = [
+        z3.Extract(data1.size() - 8 * i - 1, data1.size() - 8 * i - 8, data1)
+        == z3.Extract(data1.size() - 8 * i - 1, data1.size() - 8 * i - 8, naive2)
+        for i in range(nbytes)
+        if i not in differing
+    ]
+    t_naive = time.perf_counter() - t
+
+    size_shared = dag_size([hash1, hash2])
+    size_naive = dag_size([naive_hash1, naive_hash2] + naive_tie)
+    print(
+        f"    Formula size:      {size_shared} nodes (naive: {size_naive}, "
+        + f"{100 * size_shared / size_naive:.1f}%)"
+    )
+    print(f"    Construction time: {t_shared:.2f}s (naive: {t_naive:.2f}s)")
+
+    print("[+] Adding additional constraints to the solver")
+    s = z3.Solver()
+    s.add(data1 != data2)
+
+    # Near-collision: digests equal on the first byte.
+    s.add(
+        z3.Extract(MD5_HASH_BITLEN - 1, MD5_HASH_BITLEN - 8, hash1)
+        == z3.Extract(MD5_HASH_BITLEN - 1, MD5_HASH_BITLEN - 8, hash2)
+    )
+
+    # Digests differ exactly by the given XOR pattern on their last byte.
+    # s.add(z3.Extract(7, 0, hash1 ^ hash2) == z3.BitVecVal(0x80, 8))
+
+    print("[+] Checking for boolean satisfiability")
+    if s.check() == z3.sat:
+        print("[+] Found valid model")
+
+        m = s.model()
+        print(f"    Data 1 hex: {hex_from_bv(m.evaluate(data1))}")
+        print(f"    Data 2 hex: {hex_from_bv(m.evaluate(data2))}")
+        print(f"    MD5 hash 1: {hex_from_bv(m.evaluate(hash1))}")
+        print(f"    MD5 hash 2: {hex_from_bv(m.evaluate(hash2))}")
+
+
+def main_blocks() -> None:
+    sys.set_int_max_str_digits(0)
+
+    print("[+] Benchmarking construction for symbolic inputs of multiple blocks")
+    print(f"    {'blocks':>6} {'mode':>10} {'time [s]':>10} {'peak RSS [MiB]':>15}")
+
+    # Each construction runs in a fresh process so that peak memory is not
+    # shared between measurements.
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for nblocks in [1, 2, 4, 8, 16, 32, 48]:
+            modes = ["streaming", "monolithic"] if nblocks <= 4 else ["streaming"]
+            for mode in modes:
+                t, rss = pool.apply(bench_construction, (mode, nblocks))
+                print(f"    {nblocks:>6} {mode:>10} {t:>10.2f} {rss / 1024:>15.1f}")
+
+
+def main_sample() -> None:
+    sys.set_int_max_str_digits(0)
+
+    # Settings: ./md5-symbolic.py sample [nsamples] [budget in seconds] [nxors]
+    # The number of parity constraints is adapted to the size of the solution
+    # space while sampling; by default it starts at the number of bits of data.
+    nsamples = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    budget = float(sys.argv[3]) if len(sys.argv) > 3 else 3600.0
+    nxors = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    processes = os.cpu_count() or 1
+
+    data = z3.BitVec("data", MD5_HASH_BITLEN + 8)
+    print(
+        f"[+] Constructing bitvector of {data.size()} bits "
+        + "and the symbolic hash computation for it"
+    )
+    hash = md5hash(data)
+
+    print("[+] Adding additional constraints to the solver")
+    s = z3.Solver()
+
+    # Find messages whose checksum ends with four null bits.
+    s.add(z3.Extract(4 - 1, 0, hash) == z3.BitVecVal(0, 4))
+
+    print(
+        f"[+] Sampling {nsamples} models in {processes} processes "
+        + f"(time budget {budget:.0f}s)"
+    )
+    t = time.perf_counter()
+    found = 0
+    for dataval in sample_models(
+        s, data, nsamples, budget, nxors=nxors, processes=processes
+    ):
+        found += 1
+        print(f"    Data hex: {bytes.hex(dataval)}  MD5 hash: {md5hash_(dataval)}")
+    t = time.perf_counter() - t
+
+    print(f"[+] Found {found} samples in {t:.1f}s ({found / t:.4f} samples/s)")
+
+
+def main_backward() -> None:
+    sys.set_int_max_str_digits(0)
+
+    # Messages are only partially symbolic so that queries fixing the complete
+    # digest can be solved in reasonable time. Solving times vary a lot between
+    # messages, so they are compared over several random ones.
+    nbytes = (MD5_HASH_BITLEN + 8) // 8
+    free = 1
+    trials = 5
+
+    print(
+        "[+] Benchmarking solving of queries fixing all output words "
+        + f"({free} free bytes)"
+    )
+    print(f"    {'message':>8} {'full [s]':>10} {'rewritten [s]':>14}")
+    total = [0.0, 0.0]
+    for trial in range(trials):
+        message = bytes(random.randrange(256) for _ in range(nbytes))
+
+        data = z3.BitVec("data", nbytes * 8)
+        hash = z3.BitVec("hash", MD5_HASH_BITLEN)
+        constraints = [
+            z3.Extract(data.size() - 1, 8 * free, data)
+            == bv_from_bytes(message[: nbytes - free]),
+            hash == bv_from_bytes(bytes.fromhex(md5hash_(message))),
+        ]
+
+        times = []
+        for rewrite in [False, True]:
+            t = time.perf_counter()
+            s = z3.Solver()
+            if rewrite:
+                s.add(md5_query(data, hash, constraints, backward=True))
+            else:
+                s.add([hash == md5hash(data)] + constraints)
+            assert s.check() == z3.sat
+            times.append(time.perf_counter() - t)
+
+        total = [total[0] + times[0], total[1] + times[1]]
+        print(f"    {trial:>8} {times[0]:>10.2f} {times[1]:>14.2f}")
+    print(f"    {'total':>8} {total[0]:>10.2f} {total[1]:>14.2f}")
+
+
+def bench_construction(mode: str, nblocks: int) -> tuple[float, int]:
+    sys.set_int_max_str_digits(0)
+
+    t = time.perf_counter()
+    if mode == "streaming":
+        blocks = [z3.BitVec(f"data{k}", 512) for k in range(nblocks)]
+        md5hash_blocks(blocks, "cv")
+    else:
+        md5hash(z3.BitVec("data", nblocks * 512))
+    t = time.perf_counter() - t
+
+    return t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
 def bv_from_bytes(input: bytes, size: int | None = None) -> z3.BitVecRef:
     n = int.from_bytes(input, byteorder="big")
     if size is None:
@@ -199,6 +440,367 @@ def md5hash_(val: bytes) -> str:
     return hex_from_bv(digest)
 
 
+# Streaming construction over an input given as a sequence of per-block
+# bitvectors. All blocks must be 512 bits long, except for the last one which
+# may be shorter.
+#
+# After each full block, the chaining value is replaced by fresh variables and
+# tied to the expression computed so far by an equality constraint. That way
+# each block is constructed (and simplified) over a DAG of constant size, and
+# construction time and memory grow linearly in the number of blocks instead
+# of re-traversing everything constructed so far. The returned constraints
+# must be added to the solver together with the hash. The chaining value
+# variables are named after `name`, which must be unique per solver, as
+# instances with the same name would share them.
+def md5hash_blocks(
+    blocks: Iterable[z3.BitVecRef], name: str
+) -> tuple[z3.BitVecRef, list[z3.BoolRef]]:
+    m = MD5()
+    constraints: list[z3.BoolRef] = []
+
+    for k, block in enumerate(blocks):
+        assert m.count % 512 == 0, "Only the last block may be partial"
+        assert block.size() <= 512, f"Block has length {block.size()}"
+        m.update(block)
+
+        if m.count % 512 == 0:
+            cv = [z3.BitVec(f"{name}{k}_{i}", 32) for i in range(4)]
+            constraints += [v == e for v, e in zip(cv, m.state)]
+            m.state = cv
+
+    return z3.simplify(m.final()), constraints
+
+
+# Sample models of the constraints in `s` which are spread across the
+# solution space, projected to the bits of `data`.
+#
+# Each sample is taken from a random cell: the values of `data` satisfying
+# `nxors` random parity constraints, each over a random half of its bits. The
+# parity constraints are not handed to z3, which is bad at solving them.
+# Instead they are solved by Gaussian elimination, and `data` is replaced by an
+# affine function of the remaining free bits, so that only these have to be
+# searched: by enumeration for small cells, by z3 otherwise. A cell is only
+# used if it has at most `cellmax` solutions, all of which are enumerated and
+# one of them is picked at random, so the samples are close to uniform instead
+# of following z3's bias. Empty cells lower the number of parity constraints
+# for the next cells and too large ones raise it, starting from `nxors` (by
+# default all bits of `data`). The cells are solved in parallel worker
+# processes with different random seeds.
+#
+# Stops after `nsamples` distinct samples, after `budget` seconds, or when a
+# cell without any parity constraints is empty, i.e. `s` is unsatisfiable.
+def sample_models(
+    s: z3.Solver,
+    data: z3.BitVecRef,
+    nsamples: int,
+    budget: float,
+    nxors: int | None = None,
+    cellmax: int = 8,
+    processes: int | None = None,
+) -> Iterator[bytes]:
+    processes = processes or os.cpu_count() or 1
+    # Wall-clock time, as monotonic clocks are not comparable across processes.
+    deadline = time.time() + budget
+    seeds = itertools.count(random.randrange(1 << 32))
+    m = data.size() if nxors is None else nxors
+
+    # z3 objects cannot be shared between processes, so workers receive the
+    # formula in SMT-LIB format instead.
+    initargs = (s.to_smt2(), str(data), data.size(), cellmax, deadline)
+    results: queue.Queue[tuple[int, str, bytes | None] | BaseException]
+    results = queue.Queue()
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes, initializer=_sample_init, initargs=initargs) as pool:
+
+        def submit() -> None:
+            pool.apply_async(
+                _sample_cell,
+                (next(seeds), m),
+                callback=results.put,
+                error_callback=results.put,
+            )
+
+        for _ in range(processes):
+            submit()
+
+        seen = set()
+        while len(seen) < nsamples:
+            try:
+                res = results.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if isinstance(res, BaseException):
+                raise res
+
+            cell_nxors, status, sample = res
+            if status == "empty":
+                if cell_nxors == 0:
+                    break
+                m = min(m, cell_nxors - 1)
+            elif status == "big":
+                m = min(max(m, cell_nxors + 1), data.size())
+            elif status == "sample" and sample not in seen:
+                assert sample is not None
+                seen.add(sample)
+                yield sample
+
+            if time.time() >= deadline:
+                break
+            submit()
+
+
+# Cells with at most this many free bits are enumerated instead of solved.
+CELL_ENUMERATE_BITS = 10
+
+_sampler: tuple[list[z3.BoolRef], z3.BitVecRef, int, float] | None = None
+
+
+def _sample_init(
+    smt2: str, name: str, size: int, cellmax: int, deadline: float
+) -> None:
+    global _sampler
+    sys.set_int_max_str_digits(0)
+    assertions = list(z3.parse_smt2_string(smt2))
+    _sampler = (assertions, z3.BitVec(name, size), cellmax, deadline)
+
+
+# Solve one random cell with `nxors` parity constraints. Returns `nxors`, the
+# outcome ("sample", "empty", "big" or "timeout") and the sample if any.
+def _sample_cell(seed: int, nxors: int) -> tuple[int, str, bytes | None]:
+    assert _sampler is not None
+    assertions, data, cellmax, deadline = _sampler
+    rng = random.Random(seed)
+
+    n = data.size()
+    rows = [rng.getrandbits(n) for _ in range(nxors)]
+    rhs = [rng.getrandbits(1) for _ in range(nxors)]
+    cell = gf2_solve(rows, rhs, n)
+    if cell is None:
+        return nxors, "empty", None
+    x0, basis = cell
+
+    # Bit i of data is bit i of x0 plus the free bits j with bit i set in
+    # basis[j].
+    free = z3.BitVec(f"{data}_free", len(basis)) if basis else None
+    bits = []
+    for i in reversed(range(n)):
+        bit = z3.BitVecVal((x0 >> i) & 1, 1)
+        for j, v in enumerate(basis):
+            if (v >> i) & 1:
+                bit = bit ^ z3.Extract(j, j, free)
+        bits.append(bit)
+    value = z3.simplify(z3.Concat(bits)) if n > 1 else bits[0]
+
+    assertions = [z3.substitute(e, (data, value)) for e in assertions]
+    solutions = []
+
+    # Small cells are cheaper to enumerate concretely than to solve.
+    if len(basis) <= CELL_ENUMERATE_BITS:
+        for y in range(1 << len(basis)):
+            if time.time() >= deadline:
+                return nxors, "timeout", None
+            sub = [(free, z3.BitVecVal(y, len(basis)))] if free is not None else []
+            val = z3.simplify(z3.substitute(value, *sub))
+            if all(z3.is_true(z3.simplify(z3.substitute(e, *sub))) for e in assertions):
+                solutions.append(bytes_from_bv(val))
+                if len(solutions) > cellmax:
+                    break
+    else:
+        s = z3.Solver()
+        s.set(random_seed=seed % (1 << 32))
+        s.add(assertions)
+        while len(solutions) <= cellmax:
+            s.set(timeout=max(1, int(1000 * (deadline - time.time()))))
+            res = s.check()
+            if res == z3.unknown:
+                return nxors, "timeout", None
+            if res == z3.unsat:
+                break
+            val = s.model().evaluate(value, model_completion=True)
+            solutions.append(bytes_from_bv(val))
+            s.add(free != s.model().evaluate(free, model_completion=True))
+
+    if not solutions:
+        return nxors, "empty", None
+    if len(solutions) > cellmax:
+        return nxors, "big", None
+    return nxors, "sample", rng.choice(solutions)
+
+
+# Solve the linear system over GF(2) in `n` variables given by `rows` (bitsets
+# of the variables in each equation) and `rhs`. Returns a particular solution
+# and a basis of the null space (both as bitsets), or None if the system is
+# inconsistent.
+def gf2_solve(rows: list[int], rhs: list[int], n: int) -> tuple[int, list[int]] | None:
+    # Rows in reduced row echelon form as (pivot column, row, right-hand side).
+    pivots: list[tuple[int, int, int]] = []
+    for row, b in zip(rows, rhs):
+        for col, prow, pb in pivots:
+            if (row >> col) & 1:
+                row ^= prow
+                b ^= pb
+        if row == 0:
+            if b:
+                return None
+            continue
+
+        col = row.bit_length() - 1
+        pivots = [
+            (c, r ^ row, rb ^ b) if (r >> col) & 1 else (c, r, rb)
+            for c, r, rb in pivots
+        ]
+        pivots.append((col, row, b))
+
+    x0 = sum(b << col for col, _, b in pivots)
+    pivotcols = sum(1 << col for col, _, _ in pivots)
+
+    basis = []
+    for f in range(n):
+        if (pivotcols >> f) & 1:
+            continue
+        v = 1 << f
+        for col, r, _ in pivots:
+            if (r >> f) & 1:
+                v |= 1 << col
+        basis.append(v)
+    return x0, basis
+
+
+# Steps 61 to 64 of transform as (updated register, message word, shift,
+# constant). The arguments of each step are the registers in rotated order
+# starting with the updated one.
+LAST_STEPS = [
+    (0, 4, S41, 0xF7537E82),
+    (3, 11, S42, 0xBD3AF235),
+    (2, 2, S43, 0x2AD7D2BB),
+    (1, 9, S44, 0xEB86D391),
+]
+
+
+# Assertions for the query given by `constraints` on the symbolic `hash` of
+# `data`, where `hash` is a plain 128-bit variable.
+#
+# If `backward` is set and the constraints fix all output words of the digest
+# of a single-block message, the feed-forward additions are inverted
+# concretely, giving the final values of all registers. The last four steps are
+# then run backwards: each of them `new = b + rotl(a + I(b, c, d) + x + ac, s)`
+# updates one register, and once `new`, `b`, `c` and `d` are known, the
+# previous value of it is `a = rotr(new - b, s) - I(b, c, d) - x - ac`, which
+# only adds a dependency on the message word `x`. The query is thus that the
+# registers after step 60 equal these expressions, and the circuit for steps 61
+# to 64 and the digest is not needed. Otherwise, this is the full circuit.
+#
+# The backward pass is opt-in, as it does not reliably reduce solving time:
+# over 15 queries of the `backward` mode it took 693s against 742s for the full
+# circuit, but was faster for only 7 of them.
+def md5_query(
+    data: z3.BitVecRef,
+    hash: z3.BitVecRef,
+    constraints: list[z3.BoolRef],
+    backward: bool = False,
+) -> list[z3.BoolRef]:
+    assert data.size() % 8 == 0
+    assert hash.size() == MD5_HASH_BITLEN
+
+    fixed = fixed_words(hash, constraints)
+    if not backward or len(fixed) < 4 or not 0 < data.size() < 56 * 8:
+        return [hash == md5hash(data)] + constraints
+
+    m = MD5()
+    padLen = 56 - data.size() // 8
+    bits = encode([z3.BitVecVal(data.size(), 32), z3.BitVecVal(0, 32)])
+    block = z3.Concat(data, bv_from_bytes(PADDING[:padLen]), bits)
+    x = decode(block)
+
+    reg = [z3.simplify(z3.BitVecVal(fixed[i], 32) - m.state[i]) for i in range(4)]
+    for r, k, s, ac in reversed(LAST_STEPS):
+        b, c, d = (reg[(r + i) % 4] for i in range(1, 4))
+        reg[r] = z3.simplify(
+            bv_rotate_right(reg[r] - b, s) - I(b, c, d) - x[k] - z3.BitVecVal(ac, 32)
+        )
+
+    forward = transform(m.state, block, last_steps=False)
+    return [f == r for f, r in zip(forward, reg)] + constraints
+
+
+# Output words of the digest (as state words, i.e. in host byte order) whose
+# bits are all fixed by top-level equalities between constants and `hash` or
+# slices of it.
+def fixed_words(hash: z3.BitVecRef, constraints: list[z3.BoolRef]) -> dict[int, int]:
+    known = 0
+    value = 0
+    for c in constraints:
+        if not z3.is_eq(c):
+            continue
+        lhs, rhs = c.arg(0), c.arg(1)
+        if z3.is_bv_value(lhs):
+            lhs, rhs = rhs, lhs
+        if not z3.is_bv_value(rhs):
+            continue
+
+        if lhs.eq(hash):
+            hi, lo = hash.size() - 1, 0
+        elif z3.is_app_of(lhs, z3.Z3_OP_EXTRACT) and lhs.arg(0).eq(hash):
+            hi, lo = lhs.params()
+        else:
+            continue
+
+        mask = ((1 << (hi - lo + 1)) - 1) << lo
+        known |= mask
+        value = (value & ~mask) | (rhs.as_long() << lo)
+
+    res = {}
+    for j in range(4):
+        lo = MD5_HASH_BITLEN - 32 * (j + 1)
+        mask = 0xFFFFFFFF << lo
+        if known & mask == mask:
+            word = (value & mask) >> lo
+            res[j] = int.from_bytes(word.to_bytes(4, "big"), "little")
+    return res
+
+
+# Construct the second message of a paired query. All bytes of `data` are
+# shared with the second message except the ones at the given positions
+# (counted from the start of the message), which are replaced with fresh
+# symbolic bytes.
+#
+# The shared bytes are the same Extracts of `data`, so when both messages are
+# hashed with md5hash, z3's hash-consing shares all subterms which only depend
+# on them (e.g. the message words and the steps before the first differing
+# word) between both hash computations.
+def pair_data(
+    data: z3.BitVecRef, differing: Iterable[int], name: str = "data2"
+) -> z3.BitVecRef:
+    assert data.size() % 8 == 0
+    nbytes = data.size() // 8
+    differing = set(differing)
+    assert all(0 <= i < nbytes for i in differing)
+
+    parts = []
+    for i in range(nbytes):
+        hi = data.size() - 8 * i - 1
+        if i in differing:
+            parts.append(z3.BitVec(f"{name}_{i}", 8))
+        else:
+            parts.append(z3.Extract(hi, hi - 7, data))
+
+    return z3.simplify(z3.Concat(parts)) if len(parts) > 1 else parts[0]
+
+
+# Number of distinct nodes in the DAG spanned by the given expressions.
+def dag_size(exprs: list[z3.ExprRef]) -> int:
+    seen = set()
+    todo = list(exprs)
+    while todo:
+        e = todo.pop()
+        if e.get_id() in seen:
+            continue
+        seen.add(e.get_id())
+        todo.extend(e.children())
+    return len(seen)
+
+
 class U8:
     def __init__(self, val: int):
         self.maxval = 0xFF
@@ -240,7 +842,7 @@ class MD5:
         if input.size() >= partLen:
             self.buffer = bv_memcpy(
                 self.buffer,
-                z3.Extract(partLen - 1, 0, input),
+                z3.Extract(input.size() - 1, input.size() - partLen, input),
                 index,
                 partLen,
             )
@@ -248,7 +850,10 @@ class MD5:
 
             i = partLen
             while i + 512 - 1 < input.size():
-                self.state = transform(self.state, z3.Extract(i + 512 - 1, i, input))
+                self.state = transform(
+                    self.state,
+                    z3.Extract(input.size() - i - 1, input.size() - i - 512, input),
+                )
                 i += 512
 
             index = 0
@@ -259,7 +864,7 @@ class MD5:
         if input.size() - i != 0:
             self.buffer = bv_memcpy(
                 self.buffer,
-                z3.Extract(input.size() - 1, i, input),
+                z3.Extract(input.size() - i - 1, 0, input),
                 index,
                 input.size() - i,
             )
@@ -319,7 +924,11 @@ def decode(input: z3.BitVecRef) -> list[z3.BitVecRef]:
     return res
 
 
-def transform(state: list[z3.BitVecRef], block: z3.BitVecRef) -> list[z3.BitVecRef]:
+# Without `last_steps`, returns the registers after step 60 and leaves steps
+# 61 to 64 and the feed-forward to the caller, see md5_query.
+def transform(
+    state: list[z3.BitVecRef], block: z3.BitVecRef, last_steps: bool = True
+) -> list[z3.BitVecRef]:
     assert len(state) == 4, f"State has length f{len(block)}"
     assert (
         state[0].size() == 32
@@ -400,12 +1009,17 @@ def transform(state: list[z3.BitVecRef], block: z3.BitVecRef) -> list[z3.BitVecR
     d = II(d, a, b, c, x[15], S42, 0xFE2CE6E0)  # 58
     c = II(c, d, a, b, x[6], S43, 0xA3014314)  #  59
     b = II(b, c, d, a, x[13], S44, 0x4E0811A1)  # 60
-    a = II(a, b, c, d, x[4], S41, 0xF7537E82)  #  61
-    d = II(d, a, b, c, x[11], S42, 0xBD3AF235)  # 62
-    c = II(c, d, a, b, x[2], S43, 0x2AD7D2BB)  #  63
-    b = II(b, c, d, a, x[9], S44, 0xEB86D391)  #  64
 
-    return [state[0] + a, state[1] + b, state[2] + c, state[3] + d]
+    if not last_steps:
+        return [a, b, c, d]
+
+    # Steps 61 to 64, which md5_query also runs backwards.
+    reg = [a, b, c, d]
+    for r, k, s, ac in LAST_STEPS:
+        a, b, c, d = (reg[(r + i) % 4] for i in range(4))
+        reg[r] = II(a, b, c, d, x[k], s, ac)
+
+    return [state[i] + reg[i] for i in range(4)]
 
 
 # Replace part of a bit vector with another bit vector.
@@ -441,5 +1055,16 @@ def bv_rotate_left(x: z3.BitVecRef, n: z3.BitVecRef) -> z3.BitVecRef:
     return (x << n) | z3.LShR(x, (x.size() - n))
 
 
+def bv_rotate_right(x: z3.BitVecRef, n: z3.BitVecRef) -> z3.BitVecRef:
+    return z3.LShR(x, n) | (x << (x.size() - n))
+
+
 if __name__ == "__main__":
-    main()
+    modes = {
+        "single": main,
+        "pair": main_pair,
+        "blocks": main_blocks,
+        "sample": main_sample,
+        "backward": main_backward,
+    }
+    modes[sys.argv[1] if len(sys.argv) > 1 else "single"]()